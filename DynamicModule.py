@@ -3,8 +3,8 @@ from abc import ABCMeta, abstractmethod
 
 class DynamicModule(metaclass=ABCMeta):
     def __init__(self):
-        print("DynamicModule")
         #super().__init__()
+        pass
 
     @abstractmethod
     def init(self):
@@ -1,14 +1,113 @@
 import os
 import sys
+import json
+import hashlib
 import importlib
+import importlib.util
+import pkgutil
+import functools
+import threading
+import py_compile
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+# File name of the persisted metadata index inside the module directory
+INDEX_FILE_NAME = ".module_index"
+
+# How long to wait after a filesystem event before reloading, editors
+# tend to fire several events for a single save
+AUTORELOAD_DEBOUNCE_SECONDS = 0.1
+
+
+def _cached_import(module_path, file_path, class_name):
+    # Single sys.modules peek before falling back to a fresh load, the same
+    # shape as Django's cached_import; sys.modules is bound to a local so
+    # the lookup and the registration share one global load
+    modules = sys.modules
+    module = modules.get(module_path)
+    if module is None or getattr(module, "__spec__", None) is None:
+        # We already know the exact directory, so ask its finder for the spec
+        # instead of going through the full PathFinder search chain.
+        # pkgutil.get_importer caches one finder per directory in
+        # sys.path_importer_cache, so every module in a directory shares it
+        finder = pkgutil.get_importer(os.path.dirname(file_path))
+        spec = finder.find_spec(module_path)
+        module = importlib.util.module_from_spec(spec)
+        modules[module_path] = module
+        spec.loader.exec_module(module)
+    return module, getattr(module, class_name)
+
+
+@functools.lru_cache(maxsize=4096)
+def get_os_path(module_root_path, module_path):
+    # Convert dot-notation back to path-notation
+    module_path = module_path.replace(".", "/")
+
+    # Add extension back to path
+    module_path += ".py"
+
+    # Join from the absolute path to the module path
+    return os.path.join(module_root_path, module_path)
+
+
+@functools.lru_cache(maxsize=4096)
+def get_module_path(module_root_path, os_path):
+    # Remove the base path since that is not included in the module_path
+    os_path = os_path.replace(module_root_path, "")
+
+    # If absolute path truncate root
+    if os_path[0] == "/":
+        os_path = os_path[1:]
+
+    # Strip the extension by slicing, cheaper than the tuple and two
+    # strings os.path.splitext allocates and we only ever see .py files
+    if os_path.endswith(".py"):
+        os_path = os_path[:-3]
+
+    # Swap to dot notation
+    return os_path.replace("/", ".")
+
+
+def _hash_file(file_path):
+    # Short digest is plenty for change detection and keeps hashing cheap
+    with open(file_path, "rb") as source:
+        return hashlib.blake2b(source.read(), digest_size=8).digest()
+
+
+class ModuleEntry:
+    """
+    Record for one loaded module, slotted since one exists per module and a
+    plain dict costs several times the memory per entry
+    """
+    __slots__ = ("ref", "instance", "mtime_ns", "size", "content_hash", "class_name")
+
+    def __init__(self, ref, instance, mtime_ns, size, content_hash, class_name):
+        self.ref = ref
+        self.instance = instance
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.content_hash = content_hash
+        self.class_name = class_name
 
 
 class Manager:
     """
     Dynamic Module Manger to handle all modules loaded in dynamically
     """
-    def __init__(self, abs_module_path):
-        sys.path.insert(0, abs_module_path)
+
+    # Module directories already placed on sys.path, shared across Manager
+    # instances so repeated construction cannot grow sys.path
+    __registered_paths = set()
+
+    def __init__(self, abs_module_path, autoreload=False):
+        # Our own loads go through per-directory finders, but the modules
+        # themselves may import siblings by name, so the directory still
+        # belongs on sys.path. Append rather than insert(0) so every
+        # unrelated import in the process does not scan our directory first
+        if abs_module_path not in Manager.__registered_paths:
+            sys.path.append(abs_module_path)
+            Manager.__registered_paths.add(abs_module_path)
 
         # Holds absolute file path to module folder
         self.module_dir_path = abs_module_path
@@ -17,88 +116,239 @@ class Manager:
         # and values are module import references
         self.module_list = {}
 
+        # Per-directory mtime and listing caches so re-scans can skip
+        # directories whose contents have not changed, the same trick
+        # importlib's FileFinder uses for its directory cache
+        self._dir_mtime = {}
+        self._dir_listing = {}
+
+        # Metadata index persisted across runs so a warm start can trust
+        # the recorded content hash for unchanged files instead of reading
+        # every module source to hash it, the same idea as Metasploit's
+        # baseline module cache
+        self._index = self._load_index()
+        self._index_dirty = False
+
         self.__load_modules_from_path(self.module_dir_path)
 
-        # Invalidate Python's caches so the new modules can be found
+        # Push-based reload through a filesystem watcher instead of the
+        # caller polling mtimes; no steady-state syscalls when idle.
+        # The timer map is shared between the observer thread, the timer
+        # threads and shutdown, so it is only touched under the lock
+        self._observer = None
+        self._reload_timers = {}
+        self._reload_lock = threading.Lock()
+        if autoreload:
+            self.__start_autoreload()
+
+    def __start_autoreload(self):
+        # watchdog is an optional dependency, only needed for autoreload
+        try:
+            from watchdog.events import PatternMatchingEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            print("Error: autoreload requires the 'watchdog' package")
+            return
+
+        handler = PatternMatchingEventHandler(patterns=["*.py"], ignore_directories=True)
+        handler.on_modified = lambda event: self.__schedule_reload(event.src_path)
+        handler.on_created = handler.on_modified
+
+        self._observer = Observer()
+        self._observer.schedule(handler, self.module_dir_path, recursive=True)
+        self._observer.start()
+
+    def __schedule_reload(self, src_path):
+        # Debounce per file so one save triggers one reload
+        with self._reload_lock:
+            timer = self._reload_timers.pop(src_path, None)
+            if timer is not None:
+                timer.cancel()
+
+            timer = threading.Timer(AUTORELOAD_DEBOUNCE_SECONDS, self.__reload_from_event, (src_path,))
+            self._reload_timers[src_path] = timer
+
+        timer.start()
+
+    def __reload_from_event(self, src_path):
+        with self._reload_lock:
+            self._reload_timers.pop(src_path, None)
+
+        # Only reload modules we are actually tracking
+        module_path = self.get_module_path(self.module_dir_path, src_path)
+        if module_path not in self.module_list:
+            return
+
+        try:
+            stat_result = os.stat(src_path)
+        except OSError:
+            # File disappeared between the event and the reload
+            return
+
+        self.reload_module(module_path, src_path, stat_result.st_mtime_ns, stat_result.st_size)
         importlib.invalidate_caches()
 
     def __load_modules_from_path(self, module_root_path):
         # Load in modules dynamically from path
-        for dir_path, _, files in os.walk(module_root_path):
-            # Import all python files
-            for file in files:
-                if file.endswith(".py"):
-                    # Create a python module import path relative to the absModulePath
-                    import_path = os.path.join(
-                        dir_path.replace(module_root_path, "")[1:],
-                        os.path.splitext(file)[0]
-                    ).replace("/", ".")
-
-                    cur_module = self.module_list.get(import_path)
-
-                    # Import the python module and keep a reference to it
-                    # if it is not already imported by us
-                    if not cur_module:
-                        self.add_module(import_path)
-                    # If found module but the modified time changed then reload it
-                    elif cur_module and cur_module["mtime"] != os.path.getmtime(self.get_os_path(import_path)):
-                        self.reload_module(import_path)
-
-    @staticmethod
-    def get_os_path(module_root_path, module_path):
-        # Convert dot-notation back to path-notation
-        module_path = module_path.replace(".", "/")
-
-        # Add extension back to path
-        module_path += ".py"
-
-        # Join from the absolute path to the module path
-        return os.path.join(module_root_path, module_path)
-
-    @staticmethod
-    def get_module_path(module_root_path, os_path):
-        # Remove the base path since that is not included in the module_path
-        os_path = os_path.replace(module_root_path, "")
-
-        # If absolute path truncate root
-        if os_path[0] == "/":
-            os_path = os_path[1:]
-
-        # Swap to dot notation
-        os_path = os_path.replace("/", ".")
-
-        return os.path.splitext(os_path)[0]
+        for file_path, import_path, class_name, mtime_ns, size in self.__discover(module_root_path):
+            cur_module = self.module_list.get(import_path)
+
+            # A still-valid index entry vouches for the recorded content
+            # hash, sparing add_module the full-file read to recompute it
+            content_hash = None
+            indexed = self._index.get(import_path)
+            if indexed is not None and indexed[0] == file_path \
+                    and indexed[1] == mtime_ns and indexed[2] == size:
+                content_hash = bytes.fromhex(indexed[3])
+
+            # Import the python module and keep a reference to it
+            # if it is not already imported by us
+            if not cur_module:
+                self.add_module(import_path, file_path, class_name, mtime_ns, size, content_hash)
+            # If found module but the modified time changed then reload it
+            elif cur_module.mtime_ns != mtime_ns or cur_module.size != size:
+                self.reload_module(import_path, file_path, mtime_ns, size)
+
+            entry = self.module_list[import_path]
+            record = [file_path, mtime_ns, size, entry.content_hash.hex(), entry.class_name]
+            if self._index.get(import_path) != record:
+                self._index[import_path] = record
+                self._index_dirty = True
+
+        # Invalidate Python's caches once for the whole sweep, per-module
+        # invalidation also hits zipimport which scales with zip entries
+        importlib.invalidate_caches()
+
+        self._save_index()
+
+    def _load_index(self):
+        # Seed the metadata index from the previous run, an unreadable or
+        # corrupt index just means a cold start
+        try:
+            with open(os.path.join(self.module_dir_path, INDEX_FILE_NAME)) as index_file:
+                return json.load(index_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        # Only touch the disk when an entry actually changed, rewriting
+        # also bumps the module directory's own mtime for no reason.
+        # Bundle-backed managers have no directory to persist into
+        if not self._index_dirty or not os.path.isdir(self.module_dir_path):
+            return
+
+        # Persist the metadata index so the next startup is seeded
+        try:
+            with open(os.path.join(self.module_dir_path, INDEX_FILE_NAME), "w") as index_file:
+                json.dump(self._index, index_file)
+            self._index_dirty = False
+        except OSError as err:
+            print("Error: could not save module index: {}".format(err))
+
+    def __discover(self, module_root_path):
+        # The stat/scandir half of discovery is pure I/O and Python threads
+        # release the GIL around those syscalls, so top-level subtrees are
+        # walked in parallel; each worker touches only its own subtree's
+        # cache keys and the imports stay serial on the calling thread
+        files, subdirs = self.__list_dir(module_root_path, "")
+        yield from files
+
+        if len(subdirs) > 1:
+            workers = min(32, len(subdirs))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for subtree in executor.map(self.__scan_subtree, subdirs):
+                    yield from subtree
+        else:
+            for subdir_path, subdir_dots in subdirs:
+                yield from self.__scan_py(subdir_path, subdir_dots)
+
+    def __scan_subtree(self, subdir):
+        # Materialize a subtree scan so it can run on a worker thread
+        return list(self.__scan_py(subdir[0], subdir[1]))
+
+    def __scan_py(self, root, parent_dots=""):
+        # Walk the tree with scandir so each DirEntry's cached stat result
+        # can be reused instead of paying a getmtime stat per file later
+        files, subdirs = self.__list_dir(root, parent_dots)
+        yield from files
+        for subdir_path, subdir_dots in subdirs:
+            yield from self.__scan_py(subdir_path, subdir_dots)
+
+    def __list_dir(self, root, parent_dots):
+        # The dotted import prefix is threaded through the recursion so the
+        # import path is a single concatenation per file instead of a
+        # join/replace/splitext dance.
+        # A directory's mtime only moves when entries are added, removed or
+        # renamed, never when a file is edited in place, so an unchanged
+        # mtime means the cached names and derived strings are still valid
+        # but the per-file stats must be refreshed for the staleness check
+        dir_mtime = os.stat(root).st_mtime_ns
+        if dir_mtime == self._dir_mtime.get(root):
+            names, subdirs = self._dir_listing[root]
+            files = []
+            for file_path, import_path, class_name in names:
+                try:
+                    stat_result = os.stat(file_path)
+                except OSError:
+                    # Raced with a deletion, the next listing drops it
+                    continue
+                files.append((file_path, import_path, class_name,
+                              stat_result.st_mtime_ns, stat_result.st_size))
+            return files, subdirs
+
+        names = []
+        files = []
+        subdirs = []
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append((entry.path, parent_dots + entry.name + "."))
+                elif entry.is_file(follow_symlinks=False) and entry.name.endswith(".py"):
+                    stem = entry.name[:-3]
+                    stat_result = entry.stat()
+                    import_path = parent_dots + stem
+                    class_name = stem.capitalize()
+                    names.append((entry.path, import_path, class_name))
+                    files.append((entry.path, import_path, class_name,
+                                  stat_result.st_mtime_ns, stat_result.st_size))
+
+        self._dir_mtime[root] = dir_mtime
+        self._dir_listing[root] = (names, subdirs)
+
+        return files, subdirs
+
+    # The path helpers are pure functions of their arguments and see the
+    # same values over and over during scans and reloads, so they live at
+    # module level behind an lru_cache; kept on the class for callers
+    get_os_path = staticmethod(get_os_path)
+    get_module_path = staticmethod(get_module_path)
 
     def get_modules(self):
         return self.module_list
 
-    def add_module(self, module_path):
-        # Get the module class from the module file name
-        module_class_name = module_path
-        # If it is in sub directories then just get the module's name
-        if module_path.count("."):
-            module_class_name = module_path.split(".")[-1]
-
-
-        # Get's the module's class to call functions on
-        module = importlib.import_module(module_path)
-        module_class = getattr(module, module_class_name.capitalize())
+    def add_module(self, module_path, file_path, class_name, mtime_ns, size, content_hash=None):
+        # Get's the module and its class to call functions on, the class
+        # name is precomputed from the file stem at discovery time
+        module, module_class = _cached_import(module_path, file_path, class_name)
 
         # Create's an instance of that module's class
         module_instance = module_class()
 
-        self.module_list[module_path] = {
-            "ref": module,
-            "instance": module_instance,
-            "mtime": os.path.getmtime(os.path.join(self.get_os_path(self.module_dir_path, module_path)))
-        }
+        # A warm start hands us the hash from the persisted index,
+        # otherwise read the source once to compute it
+        if content_hash is None:
+            content_hash = _hash_file(file_path)
+
+        self.module_list[module_path] = ModuleEntry(
+            module, module_instance, mtime_ns, size, content_hash, class_name
+        )
 
         # Initialize Module
         module_instance.init()
 
     def remove_module(self, module_path):
         # Get our module reference
-        module = self.module_list[module_path]["ref"]
+        module = self.module_list[module_path].ref
 
         # Shutdown any work on that module
         module.shutdown()
@@ -108,32 +358,153 @@ class Manager:
         del self.module_list[module_path]
 
     def reload_modules(self):
-        # Reload all modules in our list
-        for module in self.module_list.values():
-            importlib.reload(module["ref"])
+        # Reload only the modules whose source mtime actually advanced,
+        # a no-change sweep costs one stat per module and zero reloads
+        for module_path in self.module_list:
+            file_path = self.get_os_path(self.module_dir_path, module_path)
+            try:
+                stat_result = os.stat(file_path)
+            except OSError:
+                # Source file is gone, nothing sensible to reload
+                continue
+
+            self.reload_module(module_path, file_path, stat_result.st_mtime_ns, stat_result.st_size)
 
         # Invalidate any caches
         importlib.invalidate_caches()
 
-    def reload_module(self, module_path):
-        # Reload module
-        importlib.reload(module_path)
+    def reload_module(self, module_path, file_path, mtime_ns, size):
+        entry = self.module_list[module_path]
+
+        # Nothing to do if the source has not actually changed
+        if entry.mtime_ns == mtime_ns and entry.size == size:
+            return
+
+        # The mtime is only a hint, rsync and tarballs routinely preserve
+        # it across content changes, so confirm with a content hash before
+        # paying for a re-exec; hashing only happens on the rare mismatch
+        content_hash = _hash_file(file_path)
+        if content_hash == entry.content_hash:
+            entry.mtime_ns = mtime_ns
+            entry.size = size
+            return
+
+        # Re-execute the module through its own loader; importlib.reload
+        # insists on parent packages being importable, which the direct
+        # finder loads never register, and would also redo the spec search
+        entry.ref.__spec__.loader.exec_module(entry.ref)
+
+        # Swap in a fresh instance so callers see the reloaded code
+        entry.instance.shutdown()
+        entry.instance = getattr(entry.ref, entry.class_name)()
+        entry.instance.init()
+
+        # Update new module metadata
+        entry.mtime_ns = mtime_ns
+        entry.size = size
+        entry.content_hash = content_hash
+
+    def build_bundle(self, out_path):
+        """
+        Compile every discovered module to bytecode and pack it into a zip
+        so frequently restarting processes can load from one archive instead
+        of paying a stat and open per source file
+        :param out_path: Path the bundle zip is written to
+        :return: out_path for convenience
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with zipfile.ZipFile(out_path, "w") as bundle:
+                for count, scanned in enumerate(self.__discover(self.module_dir_path)):
+                    file_path, import_path = scanned[0], scanned[1]
+
+                    # py_compile picks the PEP 3147 location by default, so
+                    # aim it at a scratch file we can place in the archive
+                    compiled = py_compile.compile(
+                        file_path,
+                        cfile=os.path.join(tmp_dir, "{}.pyc".format(count)),
+                        doraise=True
+                    )
+                    bundle.write(compiled, import_path.replace(".", "/") + ".pyc")
+
+        return out_path
+
+    @classmethod
+    def from_bundle(cls, bundle_path):
+        """
+        Create a Manager that serves its modules out of a bundle built by
+        build_bundle, letting zipimport collapse per-module filesystem
+        traffic into reads of a single archive
+        :param bundle_path: Path to a bundle zip created by build_bundle
+        :return: new instance of Manager class
+        """
+        # The archive goes on sys.path like a module directory would, so
+        # zipimport can also satisfy imports between bundled siblings
+        if bundle_path not in cls.__registered_paths:
+            sys.path.append(bundle_path)
+            cls.__registered_paths.add(bundle_path)
+
+        manager = cls.__new__(cls)
+        manager.module_dir_path = bundle_path
+        manager.module_list = {}
+        manager._dir_mtime = {}
+        manager._dir_listing = {}
+        manager._index = {}
+        manager._index_dirty = False
+        manager._observer = None
+        manager._reload_timers = {}
+        manager._reload_lock = threading.Lock()
+
+        # One mtime for the whole archive, entries only change together
+        bundle_mtime_ns = os.stat(bundle_path).st_mtime_ns
+
+        with zipfile.ZipFile(bundle_path) as bundle:
+            for info in bundle.infolist():
+                if not info.filename.endswith(".pyc"):
+                    continue
+
+                import_path = info.filename[:-4].replace("/", ".")
+                class_name = import_path.rpartition(".")[2].capitalize()
+
+                # pkgutil.get_importer hands back a cached zipimporter for
+                # archive-internal paths just like it does for directories
+                module, module_class = _cached_import(
+                    import_path, os.path.join(bundle_path, info.filename), class_name
+                )
+                content_hash = hashlib.blake2b(bundle.read(info.filename), digest_size=8).digest()
+
+                module_instance = module_class()
+                manager.module_list[import_path] = ModuleEntry(
+                    module, module_instance, bundle_mtime_ns, info.file_size, content_hash, class_name
+                )
+                module_instance.init()
 
-        # Update new module time
-        self.module_list[module_path]["mtime"] = os.path.getmtime(self.get_os_path(self.module_dir_path, module_path))
-
-        # Invalidate Cache
         importlib.invalidate_caches()
 
+        return manager
+
     def shutdown(self):
+        # Stop watching before tearing the modules down
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+        with self._reload_lock:
+            timers = list(self._reload_timers.values())
+            self._reload_timers.clear()
+        for timer in timers:
+            timer.cancel()
+
         for module in self.module_list.values():
-            module["instance"].shutdown()
+            module.instance.shutdown()
+
+        # Keep the on-disk index current for the next startup
+        self._save_index()
 
 
-def Init(modules_dir_path):
+def Init(modules_dir_path, autoreload=False):
     """
     Create a new instance of the Dynamic Module Loader Manager
     :param modules_dir_path: Path where dynamic modules should be loaded from, absolute or relative
+    :param autoreload: Watch the module directory and reload modules on change (requires watchdog)
     :return: new instance of Manager class
     """
     # Get absolute path to reference
@@ -149,7 +520,7 @@ def Init(modules_dir_path):
         print("Error: provided path is not a directory")
         return None
 
-    return Manager(abs_mod_dir_path)
+    return Manager(abs_mod_dir_path, autoreload=autoreload)
 
 
 if __name__ == "__main__":